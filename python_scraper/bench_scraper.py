@@ -0,0 +1,720 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the hot paths of whatsapp_scraper.py
+
+    ./bench_scraper.py            # run everything
+    ./bench_scraper.py msg_dt     # run one benchmark
+
+and a suite that times the main steps on generated exports of growing size
+
+    ./bench_scraper.py --suite --output new.json --baseline old.json
+"""
+
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Benchmarks never need deterministic anonymization
+os.environ.setdefault('SCRAPER_SALT', 'bench')
+
+import whatsapp_scraper as ws  # noqa: E402
+
+BENCHMARKS = {}
+SUITE_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+SUITE_TOLERANCE = 0.1  # slowdown over the baseline that fails the suite
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__[len('bench_'):]] = fn
+    return fn
+
+
+def timed(fn, *args) -> float:
+    """
+    Return how long a single call of fn(*args) took in seconds
+    """
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def report(name: str, count: int, unit: str, old_secs: float, new_secs: float):
+    print("%-12s %10d %s  old: %10.0f %s/s  new: %10.0f %s/s  speedup: %.1fx"
+          % (name, count, unit, count / old_secs, unit, count / new_secs, unit,
+             old_secs / new_secs))
+
+
+def make_headers(num_msgs: int, seed: int = 0) -> list:
+    """
+    (day_raw, tm_raw) pairs the way they appear in an export: in order,
+    with several messages in most minutes.
+    """
+    rnd = random.Random(seed)
+    dt = datetime.datetime(2020, 7, 28, 9, 0)
+    headers = []
+    for _ in range(num_msgs):
+        dt += datetime.timedelta(minutes=rnd.choice((0, 0, 0, 1, 2, 7)))
+        headers.append((dt.strftime("%d/%m/%y"),
+                        dt.strftime("%I:%M %p").lstrip('0').lower()))
+    return headers
+
+
+def make_export_lines(num_lines: int, seed: int = 0) -> list:
+    """
+    Lines of an export that is mostly long multi-line forwards, with the odd
+    action header mixed in.
+    """
+    rnd = random.Random(seed)
+    headers = iter(make_headers(num_lines, seed))
+    senders = ["+91 %05d %05d" % (rnd.randrange(10**5), rnd.randrange(10**5))
+               for _ in range(30)]
+    lines = []
+    while len(lines) < num_lines:
+        day_raw, tm_raw = next(headers)
+        if rnd.random() < 0.05:
+            lines.append(f"{day_raw}, {tm_raw} - {rnd.choice(senders)} left")
+            continue
+        lines.append(f"{day_raw}, {tm_raw} - {rnd.choice(senders)}: Forwarded")
+        for _ in range(rnd.choice((0, 0, 1, 5, 20))):
+            lines.append(rnd.choice((
+                "Dear all, please read this important message before 10:30",
+                "1. Do not share this with anyone",
+                "*Breaking news*: see https://example.com/a/b/c",
+                "",
+                "2/3 of the people in the area are affected")))
+    return lines[:num_lines]
+
+
+@benchmark
+def bench_msg_dt(num_msgs: int):
+    headers = make_headers(num_msgs)
+
+    def old():
+        for day_raw, tm_raw in headers:
+            ws.parse_msg_dt_slow(day_raw, tm_raw)
+
+    def new():
+        ws.parse_msg_dt.cache_clear()
+        day_fmt = ws.detect_day_fmt(headers[0][0])
+        for day_raw, tm_raw in headers:
+            ws.parse_msg_dt(day_raw, tm_raw, day_fmt)
+
+    report('msg_dt', num_msgs, 'msgs', timed(old), timed(new))
+
+
+@benchmark
+def bench_header_line(num_msgs: int):
+    # Classification is per line so scale up to a 1M line export by default
+    lines = make_export_lines(num_msgs * 10)
+
+    def old():
+        for line in lines:
+            ws.ACTION_LINE.match(line)
+            ws.MSG_LINE.match(line)
+
+    def new():
+        for line in lines:
+            ws.match_header_line(line)
+
+    report('header_line', len(lines), 'lines', timed(old), timed(new))
+
+
+@benchmark
+def bench_text_lines(num_msgs: int):
+    lines = make_export_lines(num_msgs * 10)
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+        f.flush()
+
+        def old():
+            # Streamed through a TextIOWrapper like a download
+            with open(f.name, 'rb') as content:
+                for _ in ws.iter_text_lines(content):
+                    pass
+
+        def new():
+            for _ in ws.iter_text_lines(f.name):
+                pass
+
+        report('text_lines', len(lines), 'lines', timed(old), timed(new))
+
+
+@benchmark
+def bench_filter_media(num_msgs: int):
+    for num_media in (num_msgs // 100, num_msgs // 20, num_msgs // 10):
+        media_files = [{'name': 'IMG-%d.jpg' % i} for i in range(num_media)]
+        # every other file is referenced in a message
+        media_msgs = [ws.Msg(has_media=True, media_file=media_files[i])
+                      for i in range(0, num_media, 2)]
+        media_msgs += [ws.Msg(has_media=True) for _ in range(num_media // 2)]
+
+        def old():
+            return [mf for mf in media_files
+                    if any(mf['name'] == m.media_file.get('name')
+                           for m in media_msgs)]
+
+        def new():
+            return ws.filter_superfluous_media_files(media_files, media_msgs)
+
+        assert old() == new()
+        report('filter_media', num_media, 'files', timed(old), timed(new))
+
+
+def make_history(num_msgs: int, num_senders: int = 30,
+                 multiline_rate: float = 0.2, deleted_rate: float = 0.02,
+                 omitted_rate: float = 0.05, media_rate: float = 0.05,
+                 rnd: random.Random = None) -> list:
+    """
+    Everything said in one group as (header, lines) pairs, header being the
+    first line of the message in the export. About 1 in 50 messages is an
+    action like a join. Media messages attach a file named IMG-<n>.jpg.
+    """
+    rnd = rnd or random.Random(0)
+    senders = ["+91 %05d %05d" % (rnd.randrange(10**5), rnd.randrange(10**5))
+               for _ in range(num_senders)]
+    dt = datetime.datetime(2020, 1, 1, 9, 0) + datetime.timedelta(
+        minutes=rnd.randrange(60 * 24))
+    history = []
+    while len(history) < num_msgs:
+        dt += datetime.timedelta(minutes=rnd.choice((0, 0, 1, 1, 2, 5, 30)))
+        stamp = "%s, %s" % (dt.strftime("%d/%m/%y"),
+                            dt.strftime("%I:%M %p").lstrip('0').lower())
+        sender = rnd.choice(senders)
+        if rnd.random() < 0.02:
+            history.append(("%s - %s joined using this group's invite link"
+                            % (stamp, sender), ()))
+            continue
+        roll = rnd.random()
+        if roll < deleted_rate:
+            content, lines = ws.MSG_DELETED, ()
+        elif roll < deleted_rate + omitted_rate:
+            content, lines = ws.MEDIA_OMITTED, ()
+        elif roll < deleted_rate + omitted_rate + media_rate:
+            content = "IMG-%s-WA%04d.jpg (file attached)" % (
+                dt.strftime("%Y%m%d"), len(history) % 10_000)
+            lines = ()
+        else:
+            content = "message %d from %s" % (len(history), sender[-5:])
+            lines = ()
+            if rnd.random() < multiline_rate:
+                lines = tuple(rnd.choice((
+                    "Dear all, please read this important message before 10:30",
+                    "1. Do not share this with anyone",
+                    "*Breaking news*: see https://example.com/a/b/c",
+                    "",
+                    "2/3 of the people in the area are affected"))
+                    for _ in range(rnd.randint(1, 8)))
+        history.append(("%s - %s: %s" % (stamp, sender, content), lines))
+    return history
+
+
+def generate_exports(out_dir: str, num_msgs: int = 10_000,
+                     num_groups: int = 10, num_senders: int = 30,
+                     multiline_rate: float = 0.2, deleted_rate: float = 0.02,
+                     omitted_rate: float = 0.05, media_rate: float = 0.05,
+                     num_exports: int = 3, overlap: float = 0.1,
+                     seed: int = 0) -> dict:
+    """
+    Write a realistic, deterministic WhatsApp dump to out_dir: num_msgs
+    messages spread over num_groups groups, each exported num_exports
+    times to out_dir/export<i>/. Every re-export repeats the last overlap
+    of the one before, and deletes some of the repeated messages the way
+    a real re-export would. Attached media is written to out_dir along
+    with as many files that no message references.
+    Returns counts of what was written.
+    """
+    rnd = random.Random(seed)
+    counts = {'msgs': 0, 'text_files': 0, 'media_files': 0}
+    media_names = set()
+    for group in range(num_groups):
+        history = make_history(num_msgs // num_groups, num_senders,
+                               multiline_rate, deleted_rate, omitted_rate,
+                               media_rate, rnd)
+        counts['msgs'] += len(history)
+        # n exports of length l overlapping by o cover l + (n - 1)(l - o)
+        length = -(-len(history) // (num_exports - (num_exports - 1) * overlap))
+        step = max(int(length * (1 - overlap)), 1)
+        for export in range(num_exports):
+            start = export * step
+            msgs = history[start:start + int(length)]
+            if export:
+                msgs = [(header.split(': ', 1)[0] + ': ' + ws.MSG_DELETED, ())
+                        if (i < length - step and ': ' in header
+                            and rnd.random() < deleted_rate) else (header, lines)
+                        for i, (header, lines) in enumerate(msgs)]
+            export_dir = os.path.join(out_dir, 'export%d' % export)
+            os.makedirs(export_dir, exist_ok=True)
+            path = os.path.join(export_dir,
+                                'WhatsApp Chat with group%d.txt' % group)
+            with open(path, 'w', encoding='utf-8') as f:
+                for header, lines in msgs:
+                    f.write(header + '\n')
+                    for line in lines:
+                        f.write(line + '\n')
+            counts['text_files'] += 1
+        for header, _ in history:
+            if header.endswith(' (file attached)'):
+                media_names.add(header.rsplit(': ', 1)[1][:-len(' (file attached)')])
+    media_names |= {'IMG-00000000-WA%04d.jpg' % i for i in range(len(media_names))}
+    for name in media_names:
+        with open(os.path.join(out_dir, name), 'wb') as f:
+            f.write(name.encode() * rnd.randint(1, 64))
+    counts['media_files'] = len(media_names)
+    return counts
+
+
+# Frozen copy of the Msg merge before MsgBatch and the windowed merge, so
+# the benchmarks keep measuring against the original implementation
+
+def check_match_pairwise(msgs_a: list, msgs_b: list, offset: int):
+    """
+    check_match as it was, walking both lists with IndexError checks
+    """
+    matches = 0
+    for i in range(-1 * offset, len(msgs_a) + len(msgs_b)):
+        try:
+            if i + offset < 0:
+                continue
+            msg_a = msgs_a[i + offset]
+        except IndexError:
+            continue
+        try:
+            if i < 0:
+                continue
+            msg_b = msgs_b[i]
+        except IndexError:
+            continue
+
+        if msg_a.sender_id != msg_b.sender_id:
+            return False
+        if abs((msg_a.dt - msg_b.dt).total_seconds()) > 61:
+            return False
+
+        if not msg_a.is_original() or not msg_b.is_original():
+            continue
+
+        if msg_a.content != msg_b.content:
+            return False
+
+        matches += 1
+        if matches > 20:
+            return True
+
+    alt_min_match_len = min(len(msgs_a), len(msgs_b)) // 2
+    if matches >= 3 or matches >= alt_min_match_len:
+        return matches
+    return False
+
+
+def find_offset_pairwise(msg_set_a: list, msg_set_b: list) -> int:
+    """
+    The find_offset that tried every pair of messages within a minute
+    """
+    checked_offsets = set()
+    possible_matches = {}
+    for msg_a in msg_set_a:
+        if msg_set_b[0].dt - msg_a.dt > 1 * ws.MINUTES:
+            continue
+        for msg_b in msg_set_b:
+            if msg_b.dt - msg_a.dt > 1 * ws.MINUTES:
+                continue
+            if msg_a.dt - msg_b.dt > 1 * ws.MINUTES:
+                break
+            offset = msg_a.order - msg_b.order
+            if offset in checked_offsets:
+                continue
+            match_score = check_match_pairwise(msg_set_a, msg_set_b, offset)
+            if match_score is True:
+                return offset
+            if match_score and isinstance(match_score, int):
+                possible_matches[offset] = match_score
+            checked_offsets.add(offset)
+    if possible_matches:
+        return max(possible_matches.keys(),
+                   key=lambda o: possible_matches[o])
+    raise AssertionError("The two sets of messages do not overlap")
+
+
+def merge_given_offset_pairwise(msgs_a: list, msgs_b: list, offset: int) -> list:
+    """
+    merge_msgs_given_offset as it was
+    """
+    assert msgs_a[0].dt <= msgs_b[0].dt
+    ret = []
+    i = -1 * offset - 1
+    while True:
+        i += 1
+        msg_a, msg_b = None, None
+        try:
+            msg_a = msgs_a[i + offset]
+        except IndexError:
+            pass
+        try:
+            if i >= 0:
+                msg_b = msgs_b[i]
+        except IndexError:
+            pass
+        if msg_a and msg_b:
+            ret.append(msg_a.merge(msg_b))
+            continue
+        if msg_a:
+            ret.append(msg_a)
+            continue
+        if msg_b:
+            ret.append(msg_b)
+            continue
+        return ret
+
+
+def merge_two_pairwise(msgs_a: list, msgs_b: list) -> list:
+    """
+    merge_two_msg_lists as it was
+    """
+    assert len(set(m.order for m in msgs_a)) == len(msgs_a)
+    assert len(set(m.order for m in msgs_b)) == len(msgs_b)
+
+    if msgs_a[0].dt > msgs_b[0].dt:
+        msgs_a, msgs_b = msgs_b, msgs_a
+
+    if msgs_a[-1].dt < msgs_b[0].dt:
+        merged = msgs_a + msgs_b
+    else:
+        offset = find_offset_pairwise(msgs_a, msgs_b)
+        merged = merge_given_offset_pairwise(msgs_a, msgs_b, offset)
+    for i, msg in enumerate(merged):
+        msg.set_order(i)
+    return merged
+
+
+def make_overlapping_groups(num_msgs: int, burst: int, seed: int = 0):
+    """
+    Two exports of the same group that overlap by half. The overlap starts
+    in a burst of forwards that all share a minute.
+    """
+    rnd = random.Random(seed)
+    senders = ['sender%d' % i for i in range(5)]
+    dt = datetime.datetime(2020, 7, 28, 9, 0)
+    msgs = []
+    for i in range(num_msgs):
+        if not num_msgs // 2 - burst < i <= num_msgs // 2:
+            dt += datetime.timedelta(minutes=1)
+        msgs.append(ws.Msg(dt=dt, sender_id=rnd.choice(senders),
+                           content=rnd.choice(('ok', 'Forwarded', 'hi')),
+                           group_id='group'))
+    msgs_a = msgs[:num_msgs * 3 // 4]
+    msgs_b = [ws.Msg(**m.as_dict()) for m in msgs[num_msgs // 2:]]
+    for msgs_x in (msgs_a, msgs_b):
+        for i, msg in enumerate(msgs_x):
+            msg.order = i
+    return msgs_a, msgs_b
+
+
+@benchmark
+def bench_find_offset(num_msgs: int):
+    num_msgs = min(num_msgs, 20_000)
+    for burst in (10, 500, 2000):
+        print("burst of %d messages in the same minute:" % burst)
+        msgs_a, msgs_b = make_overlapping_groups(num_msgs, burst)
+        assert ws.find_offset(msgs_a, msgs_b) == num_msgs // 2
+        report('find_offset', num_msgs, 'msgs',
+               timed(find_offset_pairwise, msgs_a, msgs_b),
+               timed(ws.find_offset, msgs_a, msgs_b))
+
+
+def make_weekly_exports(num_msgs: int, num_files: int, seed: int = 0) -> list:
+    """
+    The messages of num_files weekly exports of one group. Each export
+    repeats the last 10% of the one before it.
+    """
+    rnd = random.Random(seed)
+    history = [(datetime.datetime(2020, 1, 1) + datetime.timedelta(minutes=i),
+                'sender%d' % rnd.randrange(20), 'msg %d' % i)
+               for i in range(num_msgs)]
+    length = num_msgs // num_files
+    step = length - length // 10
+    msgs = []
+    for file_idx in range(num_files):
+        start = file_idx * step
+        for order, (dt, sender_id, content) in enumerate(
+                history[start:start + length]):
+            msgs.append(ws.Msg(dt=dt, sender_id=sender_id, content=content,
+                               group_id='group', order=order,
+                               file_idx=file_idx))
+    return msgs
+
+
+def merge_files_pairwise(msgs_in_grp: list) -> list:
+    """
+    merge_msgs_in_group as it was, re-merging the accumulated list with one
+    file at a time
+    """
+    msgs_by_file = list(ws.group_by_file(msgs_in_grp).values())
+    ret = msgs_by_file.pop()
+    while msgs_by_file:
+        ret = merge_two_pairwise(ret, msgs_by_file.pop())
+
+    unique_content_in = set(m.content for m in msgs_in_grp if m.is_original())
+    unique_content_out = set(m.content for m in ret if m.is_original())
+    assert not unique_content_in - unique_content_out
+    assert set(m.order for m in ret) == set(range(len(ret)))
+    return ret
+
+
+@benchmark
+def bench_merge_group(num_msgs: int):
+    for num_files in (2, 10, 30):
+        old_msgs = make_weekly_exports(num_msgs, num_files)
+        new_msgs = make_weekly_exports(num_msgs, num_files)
+        old_secs = timed(merge_files_pairwise, old_msgs)
+        new_secs = timed(ws.merge_msgs_in_group, 'group', new_msgs)
+        print("%d files:" % num_files)
+        report('merge_group', len(new_msgs), 'msgs', old_secs, new_secs)
+
+
+@benchmark
+def bench_msg_batch(num_msgs: int):
+    # What a merge worker did with a group: the original Msg merge on Msg
+    # objects rebuilt from the old wire format, or what it does now: merge
+    # a MsgBatch
+    for num_files in (2, 10, 30):
+        msgs = make_weekly_exports(num_msgs, num_files)
+        batch = ws.MsgBatch.from_msgs(('GOOGLE_DRIVE', '', 'group'), msgs)
+
+        def old():
+            merge_files_pairwise([ws.Msg(**m.as_dict(), file_idx=m.file_idx)
+                                  for m in msgs])
+
+        print("%d files, %d bytes pickled:"
+              % (num_files, len(pickle.dumps(batch))))
+        report('msg_batch', len(msgs), 'msgs', timed(old), timed(batch.merge))
+
+
+@benchmark
+def bench_merge_workers(num_msgs: int):
+    def make_groups():
+        msgs = []
+        for group in range(200):
+            for msg in make_weekly_exports(num_msgs // 200, 5, seed=group):
+                msg.group_id = 'group%d' % group
+                msgs.append(msg)
+        return msgs
+
+    workers = max(os.cpu_count(), 2)
+    serial = timed(ws.merge_all_msgs, make_groups())
+    in_pool = timed(ws.merge_all_msgs, make_groups(), workers)
+    print("%d workers:" % workers)
+    report('merge_all', num_msgs, 'msgs', serial, in_pool)
+
+
+def peak_bytes(fn, *args) -> int:
+    """
+    The most memory a single call of fn(*args) allocated at once
+    """
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@benchmark
+def bench_save_local(num_msgs: int):
+    msgs = make_weekly_exports(num_msgs, 1)
+    with tempfile.TemporaryDirectory() as out_dir:
+        path = os.path.join(out_dir, 'msgs')
+
+        def old():
+            # The whole list serialized to one string first
+            with open(path + '.json', 'w') as f:
+                f.write(json.dumps([m.as_dict() for m in msgs]))
+
+        for output_format, compression in (('json', None), ('ndjson', None),
+                                           ('ndjson', 'gzip'), ('ndjson', 'zstd')):
+            fn = path + '.' + output_format + ws.COMPRESSIONS.get(compression, '')
+            new = functools.partial(ws.write_records, fn,
+                                    (m.as_dict() for m in msgs),
+                                    output_format, compression)
+            try:
+                new_secs = timed(new)
+            except ImportError:
+                continue
+            # new's generator is used up, so make another
+            new = functools.partial(ws.write_records, fn,
+                                    (m.as_dict() for m in msgs),
+                                    output_format, compression)
+            print("%s, %s: %d bytes on disk, peak memory old: %.1f MB new: %.1f MB"
+                  % (output_format, compression, os.path.getsize(fn),
+                     peak_bytes(old) / 1e6, peak_bytes(new) / 1e6))
+            report('save_local', len(msgs), 'msgs', timed(old), new_secs)
+
+
+def import_secs(code: str, repeat: int = 5) -> float:
+    """
+    The fastest of repeat fresh interpreters running code, in seconds
+    """
+    run = functools.partial(subprocess.run, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return min(timed(run, [sys.executable, '-c', code]) for _ in range(repeat))
+
+
+def slowest_imports(module: str, count: int = 5) -> list:
+    """
+    The count slowest imports that importing module pulls in, from
+    python -X importtime, as (cumulative microseconds, name)
+    """
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True).stderr
+    imports = []
+    for line in stderr.splitlines()[1:]:
+        _, cumulative, name = line.split('|')
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+@benchmark
+def bench_startup(num_msgs: int):
+    # The module as it was loaded boto3, pymongo, dateutil and the Google
+    # clients up front
+    old = import_secs("import whatsapp_scraper, boto3, pymongo, dateutil.parser, "
+                      "googleapiclient.discovery, googleapiclient.http, "
+                      "google_auth_oauthlib.flow, google.oauth2.service_account")
+    new = import_secs("import whatsapp_scraper")
+    report('startup', 1, 'runs', old, new)
+    for cumulative, name in slowest_imports('whatsapp_scraper'):
+        print("  %8.1f ms  %s" % (cumulative / 1000, name))
+
+
+def time_steps(num_msgs: int, seed: int = 0) -> dict:
+    """
+    Seconds each main step takes on a generated dump of num_msgs messages
+    """
+    steps = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        generate_exports(out_dir, num_msgs,
+                         num_groups=max(1, min(num_msgs // 1000, 100)),
+                         seed=seed)
+        text_files, media_files = ws.separate_text_and_media_files(
+            ws.get_files_from_local_dir(out_dir))
+        media_files_by_name = {mf['name']: mf for mf in media_files}
+
+        def parse():
+            msgs = []
+            for file_idx, text_file in enumerate(text_files):
+                msgs += ws.process_text_file(text_file, media_files_by_name,
+                                             file_idx, 'bench')
+            return msgs
+
+        start = time.perf_counter()
+        msgs = parse()
+        steps['process_text_file'] = time.perf_counter() - start
+
+    media_msgs = [m for m in msgs if m.has_media]
+    steps['filter_superfluous_media_files'] = timed(
+        ws.filter_superfluous_media_files, media_files, media_msgs)
+
+    start = time.perf_counter()
+    merged = ws.merge_all_msgs(msgs)
+    steps['merge_all_msgs'] = time.perf_counter() - start
+
+    # The server has the first 70% of every group and the new scrape
+    # starts 10% before that ends
+    existing, new = [], []
+    for msgs_in_group in ws.group_msgs(merged).values():
+        cut = len(msgs_in_group) * 7 // 10
+        existing += [m.as_dict() for m in msgs_in_group[:cut]]
+        for order, msg in enumerate(msgs_in_group[cut - len(msgs_in_group) // 10:]):
+            new.append(ws.Msg(**msg.as_dict()))
+            new[-1].order = order
+    steps['merge_msgs_from_server'] = timed(ws.merge_msgs_from_server,
+                                            new, existing)
+
+    start = time.perf_counter()
+    json.dumps([m.as_dict() for m in merged])
+    steps['as_dict'] = time.perf_counter() - start
+    return steps
+
+
+def compare(results: dict, baseline: dict,
+            tolerance: float = SUITE_TOLERANCE) -> bool:
+    """
+    Print every step's time against the baseline. Returns whether any step
+    got more than tolerance slower.
+    """
+    slower = False
+    for size, steps in results['sizes'].items():
+        for step, secs in steps.items():
+            old_secs = baseline['sizes'].get(size, {}).get(step)
+            if old_secs is None:
+                continue
+            change = secs / old_secs - 1
+            flag = ''
+            if change > tolerance:
+                flag = '  SLOWER'
+                slower = True
+            print("%9s %-32s old: %8.4fs  new: %8.4fs  %+6.1f%%%s"
+                  % (size, step, old_secs, secs, change * 100, flag))
+    return slower
+
+
+def run_suite(sizes: list, output: str = None, baseline: str = None,
+              tolerance: float = SUITE_TOLERANCE) -> bool:
+    """
+    Time the main steps at every size, optionally saving the results and
+    comparing them with a baseline saved before. Small sizes are run a few
+    times and the fastest time kept to steady them. Returns whether
+    anything got slower than the baseline.
+    """
+    results = {'python': platform.python_version(),
+               'datetime': datetime.datetime.now().isoformat(),
+               'sizes': {}}
+    for size in sizes:
+        runs = [time_steps(size)
+                for _ in range(min(max(100_000 // size, 1), 5))]
+        steps = {step: min(run[step] for run in runs) for step in runs[0]}
+        results['sizes'][str(size)] = steps
+        for step, secs in steps.items():
+            print("%9d %-32s %8.4fs  %10.0f msgs/s"
+                  % (size, step, secs, size / secs))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not baseline:
+        return False
+    with open(baseline) as f:
+        return compare(results, json.load(f), tolerance)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Benchmarks for whatsapp_scraper.py")
+    parser.add_argument('names', nargs='*', choices=[[]] + list(BENCHMARKS),
+                        help='Benchmarks to run (default: all)')
+    parser.add_argument('-n', '--num-msgs', type=int, default=100_000)
+    parser.add_argument('--suite', action='store_true',
+                        help='Time the main steps at --sizes messages instead')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SUITE_SIZES)
+    parser.add_argument('--output', help='Save suite results to this json file')
+    parser.add_argument('--baseline',
+                        help='Compare suite results with this saved --output')
+    parser.add_argument('--tolerance', type=float, default=SUITE_TOLERANCE,
+                        help='Fail if a step is this much slower than the '
+                             'baseline')
+    args = parser.parse_args()
+
+    if args.suite:
+        sys.exit(run_suite(args.sizes, args.output, args.baseline,
+                           args.tolerance))
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name](args.num_msgs)
@@ -1,12 +1,48 @@
 #!/usr/bin/env python3
 
+import asyncio
 import copy
+import hashlib
 import io
+import json
+import os
+import pstats
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import tracemalloc
+import zipfile
 from datetime import datetime, timedelta
 
+import httplib2
+import pytest
+from googleapiclient.discovery import build
+
 from whatsapp_scraper import (merge_msgs_from_server, process_text_file,
                               encrypt_string, filter_superfluous_media_files,
-                              merge_all_msgs, Msg, set_media_hash)
+                              merge_all_msgs, Msg, set_media_hash,
+                              iter_text_file_msgs, parse_msg_dt,
+                              parse_msg_dt_slow, detect_day_fmt, Anonymizer,
+                              match_header_line, ACTION_LINE, MSG_LINE,
+                              download_files, content_buffer_factory,
+                              save_to_local, close_contents, MediaCache,
+                              open_content, Checkpoint,
+                              find_offset, MSG_DELETED, merge_msgs_in_group,
+                              merge_two_msg_lists, merge_process_pool,
+                              MsgBatch, msgs_from_merged_batch, msg_sort,
+                              create_indexes, find_overlap_window,
+                              save_msgs_to_mongo, upload_media_to_s3, Pipeline,
+                              partition_media_files, AsyncDriveClient,
+                              SharedResources, main_batch, read_manifest,
+                              iter_text_lines, main, ZIP_ARCHIVE, LOCAL_DIR,
+                              separate_text_and_media_files,
+                              get_files_from_local_dir, write_records,
+                              iter_records, OUTPUT_FORMATS, COMPRESSIONS,
+                              needs_gdrive_credentials, retry_delay,
+                              TransferProgress, StageProfiler,
+                              REQ_WHATSAPP_ENV_VARS)
 
 TEST_TEXT_CONTENT = """
 28/07/20, 7:18 pm - Messages to this group are now secured with end-to-end encryption. Tap for more info.
@@ -127,6 +163,25 @@ def test_merge_msgs_from_server_2():
     assert msgs[1] == Msg(group_id='a', order=4, content='gh', sender_id='zz', dt=TEST_DT + MINUTES * 2)
 
 
+def test_merge_msgs_from_server_3():
+    # The earliest message of the window on the server doesn't have its
+    # lowest order. New orders continue from the lowest one
+
+    existing_msgs = [
+        Msg(group_id='a', order=11, content='ab', sender_id='zz', dt=TEST_DT),
+        Msg(group_id='a', order=10, content='cd', sender_id='zz', dt=TEST_DT + MINUTES * 1)
+    ]
+
+    msgs = [
+        Msg(group_id='a', order=0, content='ef', sender_id='zy', dt=TEST_DT + MINUTES * 2),
+        Msg(group_id='a', order=1, content='gh', sender_id='zz', dt=TEST_DT + MINUTES * 2)
+    ]
+
+    merge_msgs_from_server(msgs, [m.as_dict() for m in existing_msgs])
+
+    assert [m.order for m in msgs] == [12, 13]
+
+
 def make_text_file(content, group_name="test"):
     fake_file = io.BytesIO(content.encode())
     return {
@@ -252,3 +307,1107 @@ def test_merge_msgs():
     assert merged[-1].content == 'Back'
 
     # assert  == msgs0
+
+
+def test_iter_text_file_msgs(tmp_path):
+    text_file = make_text_file(TEST_TEXT_CONTENT)
+    msgs = process_text_file(text_file, {}, 0, "g/drive/dir")
+
+    # the stream yields the same messages and leaves the file open
+    text_file['content'].seek(0)
+    stream = iter_text_file_msgs(text_file, {}, 0, "g/drive/dir")
+    first = next(stream)
+    assert first.content == 'Hi' and first.order == 0
+    assert [first] + list(stream) == msgs
+    assert not text_file['content'].closed
+
+    # and can be read straight from a path on disk
+    path = tmp_path / "export.txt"
+    path.write_bytes(TEST_TEXT_CONTENT.replace('\n', '\r\n').encode())
+    path_file = {'name': text_file['name'], 'content': str(path)}
+    from_path = process_text_file(path_file, {}, 0, "g/drive/dir")
+    assert [m.order for m in from_path] == list(range(len(msgs)))
+    assert from_path[4].content == 'Yea\r\nLet me write\r\nThree lines'
+    for msg in from_path:
+        msg.content = msg.content.replace('\r', '')
+    assert from_path == msgs
+
+
+def test_iter_mapped_lines(tmp_path, monkeypatch):
+    # Chunks smaller than some lines, and exports with and without a final
+    # newline read the same mapped as streamed
+    monkeypatch.setattr('whatsapp_scraper.TEXT_CHUNK_SIZE', 16)
+    path = tmp_path / "export.txt"
+    for content in ('', '\n', 'a\n\nb', TEST_TEXT_CONTENT,
+                    TEST_TEXT_CONTENT.replace('\n', '\r\n') + 'no newline',
+                    'x' * 100 + '\nशब्द\n' * 10):
+        path.write_bytes(content.encode())
+        assert list(iter_text_lines(str(path))) == \
+            list(iter_text_lines(io.BytesIO(content.encode())))
+
+
+def test_parse_msg_dt():
+    for day_raw in ('28/07/20', '1/7/69', '28/07/2020', '31/12/1999'):
+        day_fmt = detect_day_fmt(day_raw)
+        for tm_raw in ('12:05 am', '12:05 pm', '0:05', '7:05 PM', '23:59',
+                       '07:5', '9:00 AM'):
+            fast = parse_msg_dt(day_raw, tm_raw, day_fmt)
+            assert fast == parse_msg_dt_slow(day_raw, tm_raw)
+    assert parse_msg_dt('28/07/20', '7:18 pm') == datetime(2020, 7, 28, 19, 18)
+
+
+def test_anonymizer():
+    anonymizer = Anonymizer()
+    group_id = anonymizer.encrypt("WhatsApp Chat with test")
+    assert group_id == encrypt_string("WhatsApp Chat with test")
+    assert (anonymizer.encrypt("+91 12345 12345", group_id)
+            == encrypt_string("+91 12345 12345", group_id))
+    anonymizer.encrypt("+91 12345 12345", group_id)
+    assert anonymizer.encrypt.cache_info().hits == 1
+    assert anonymizer.digest("[]") == encrypt_string("[]")
+
+    fast = Anonymizer('blake2b', salt='abc')
+    assert fast.encrypt("+91 12345 12345", group_id) != encrypt_string("+91 12345 12345", group_id)
+    assert (fast.encrypt("+91 12345 12345", group_id)
+            == Anonymizer('blake2b', salt='abc').digest("+91 12345 12345", group_id))
+    assert fast.digest("a", "bc") != fast.digest("ab", "c")
+
+    with pytest.raises(ValueError):
+        Anonymizer('md5')
+
+
+def test_match_header_line():
+    lines = (TEST_TEXT_CONTENT + TEST_TEXT_CONTENT_2).split('\n') + [
+        "28/07/20, 7:50 pm - +91 12345 54321: a: b",
+        "28/07/20, 19:50 - +91 12345 54321:no space",
+        "28/07/20, 7:50 PM - Forward: 10:30 today",
+        "2/3 of people agree",
+        "10:30 - +91 12345 54321: Hi",
+    ]
+    for line in lines:
+        match = match_header_line(line)
+        msg_match = MSG_LINE.match(line)
+        action_match = ACTION_LINE.match(line)
+        if msg_match:
+            assert match['sn'] == msg_match['sn']
+            assert match['tail'] == msg_match['tail']
+            assert match['tm'] == msg_match['tm']
+        elif action_match:
+            assert match['sn'] is None
+            assert match['action'] == action_match['tail']
+        else:
+            assert match is None
+
+
+class FakeDriveHttp():
+    """
+    Stands in for httplib2 so that a real Drive Resource can be used offline.
+    Serves file contents by id and can fail the first requests for a file.
+    Lists the files of folders given as {folder_id: files}.
+    """
+
+    def __init__(self, contents: dict, failures: dict = None,
+                 folders: dict = None):
+        self.contents = contents
+        self.failures = failures or {}
+        self.folders = folders or {}
+        self.requested = []
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        if not re.search(r"/files/", uri):
+            folder_id = re.search(r"%22([^%]+)%22\+in\+parents", uri)[1]
+            return (httplib2.Response({'status': 200}),
+                    json.dumps({'files': self.folders[folder_id]}).encode())
+        file_id = re.search(r"/files/([^/?]+)", uri)[1]
+        self.requested.append(file_id)
+        if self.failures.get(file_id):
+            status = self.failures[file_id].pop(0)
+            return httplib2.Response({'status': status}), b''
+        content = self.contents[file_id]
+        start, end = map(int, headers['range'][len('bytes='):].split('-'))
+        chunk = content[start:end + 1]
+        return httplib2.Response({
+            'status': 206,
+            'content-range': 'bytes %d-%d/%d' % (start, start + len(chunk) - 1,
+                                                 len(content))}), chunk
+
+
+def fake_drive_factory(fake_http: FakeDriveHttp):
+    services = []
+
+    def factory():
+        services.append(threading.get_ident())
+        return build('drive', 'v3', http=fake_http, cache_discovery=False)
+    return factory, services
+
+
+def test_download_files():
+    contents = {'id%d' % i: b'content %d' % i for i in range(20)}
+    fake_http = FakeDriveHttp(contents, failures={'id3': [429, 503]})
+    factory, services = fake_drive_factory(fake_http)
+    files = [{'id': file_id, 'mimeType': 'jpg'} for file_id in contents]
+
+    download_files(files, factory, workers=4, backoff=0)
+
+    assert {f['id']: f['content'].read() for f in files} == contents
+    for f in files:
+        assert f['hash'] == hashlib.sha256(contents[f['id']]).hexdigest()
+    assert fake_http.requested.count('id3') == 3
+    # one Resource per thread
+    assert len(services) == len(set(services)) <= 4
+
+    fake_http = FakeDriveHttp(contents, failures={'id3': [404]})
+    factory, _ = fake_drive_factory(fake_http)
+    with pytest.raises(Exception, match="404"):
+        download_files(files, factory, workers=4, backoff=0)
+
+
+class FakeDriveServer():
+    """
+    A local aiohttp server with the Drive v3 endpoints the scraper uses.
+    Can fail the first requests for a file like FakeDriveHttp.
+    """
+
+    def __init__(self, contents: dict, failures: dict = None):
+        self.contents = contents
+        self.failures = failures or {}
+        self.files = [{'id': file_id, 'name': file_id, 'mimeType': 'image/jpeg',
+                       'size': str(len(content))}
+                      for file_id, content in contents.items()]
+        self.list_params = []
+        self.requested = []
+        self.auth = []
+        self.ignore_range = False
+        self.on_failure = None
+
+    async def list_files(self, request):
+        from aiohttp import web
+        self.list_params.append(dict(request.query))
+        start = int(request.query.get('pageToken', 0))
+        end = start + int(request.query.get('pageSize', 100))
+        resp = {'files': self.files[start:end]}
+        if end < len(self.files):
+            resp['nextPageToken'] = str(end)
+        return web.json_response(resp)
+
+    async def get_media(self, request):
+        from aiohttp import web
+        file_id = request.match_info['file_id']
+        byte_range = request.headers.get('Range')
+        self.requested.append((file_id, byte_range))
+        self.auth.append(request.headers.get('Authorization'))
+        if self.failures.get(file_id):
+            if self.on_failure:
+                self.on_failure()
+            return web.Response(status=self.failures[file_id].pop(0))
+        content = self.contents[file_id]
+        if not byte_range or self.ignore_range:
+            return web.Response(body=content)
+        start, end = map(int, byte_range[len('bytes='):].split('-'))
+        return web.Response(status=206, body=content[start:end + 1])
+
+    def __enter__(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/files', self.list_files)
+        app.router.add_get('/files/{file_id}', self.get_media)
+        self.runner = web.AppRunner(app)
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = 'http://127.0.0.1:%d' % port
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def test_async_drive_client():
+    pytest.importorskip('aiohttp')
+    contents = {'id%d' % i: b'content %d' % i * 10 for i in range(2500)}
+    with FakeDriveServer(contents, failures={'id3': [429, 503]}) as server, \
+            AsyncDriveClient(base_url=server.base_url, range_size=40) as client:
+        files = client.get_files_from_drive('drive')
+        assert [f['id'] for f in files] == list(contents)
+        assert len(server.list_params) == 3
+        assert server.list_params[0]['pageSize'] == '1000'
+        assert server.list_params[0]['q'] == '"drive" in parents'
+
+        files = files[:20]
+        client.download_files(files, workers=4, backoff=0)
+        assert {f['id']: f['content'].read() for f in files} == \
+            {f['id']: contents[f['id']] for f in files}
+        for f in files:
+            assert f['hash'] == hashlib.sha256(contents[f['id']]).hexdigest()
+        # 90 bytes in ranges of 40
+        assert [r for file_id, r in server.requested if file_id == 'id0'] == \
+            ['bytes=0-39', 'bytes=40-79', 'bytes=80-89']
+        assert [file_id for file_id, _ in server.requested].count('id3') == 5
+
+        server.failures['id1'] = [404]
+        with pytest.raises(Exception, match="404"):
+            client.download_files(files, workers=4, backoff=0)
+
+
+class FakeCredentials():
+    def __init__(self):
+        self.token = None
+        self.refreshed_on = []
+
+    @property
+    def valid(self):
+        return self.token is not None
+
+    def refresh(self, request):
+        self.refreshed_on.append(threading.current_thread())
+        self.token = 'token%d' % len(self.refreshed_on)
+
+
+def test_async_drive_client_tokens_and_ranges():
+    pytest.importorskip('aiohttp')
+    contents = {'id0': b'content 0' * 10}
+    credentials = FakeCredentials()
+    with FakeDriveServer(contents, failures={'id0': [429]}) as server, \
+            AsyncDriveClient(credentials, base_url=server.base_url) as client:
+        # The token expires while the download backs off
+        server.on_failure = lambda: setattr(credentials, 'token', None)
+        files = [{'id': 'id0', 'mimeType': 'jpg'}]
+        client.download_files(files, backoff=0)
+        assert files[0]['content'].read() == contents['id0']
+        assert server.auth == ['Bearer token1', 'Bearer token2']
+        # Refreshes block, so they don't run on the event loop
+        assert client.thread not in credentials.refreshed_on
+
+    with FakeDriveServer(contents) as server, \
+            AsyncDriveClient(base_url=server.base_url, range_size=40) as client:
+        server.ignore_range = True
+        files = [{'id': 'id0', 'mimeType': 'jpg', 'size': '90'}]
+        with pytest.raises(IOError, match="instead of 206"):
+            client.download_files(files, backoff=0)
+
+
+def test_retry_delay_and_progress(caplog):
+    assert retry_delay(404, 0, 3, 1, "from 'x'") is None
+    assert retry_delay(503, 3, 3, 1, "from 'x'") is None
+    assert 4 <= retry_delay(503, 2, 3, 1, "from 'x'") < 8
+
+    caplog.set_level('INFO')
+    progress = TransferProgress("Uploaded", 45)
+    for _ in range(45):
+        progress.add(10)
+    assert progress.num_bytes == 450
+    logged = [r.getMessage() for r in caplog.records
+              if r.getMessage().startswith("Uploaded")]
+    assert len(logged) == 23
+    assert logged[-1].startswith("Uploaded 45/45 files")
+
+
+def test_spooled_media(tmp_path, monkeypatch):
+    contents = {'small': b'x' * 10, 'big': b'y' * 5000}
+    factory, _ = fake_drive_factory(FakeDriveHttp(contents))
+    media_files = [{'id': file_id, 'mimeType': 'jpg'} for file_id in contents]
+    spool_dir = tmp_path / 'spool'
+    spool_dir.mkdir()
+
+    download_files(media_files, factory, workers=2,
+                   buffer_factory=content_buffer_factory(100, str(spool_dir)))
+    for media_file in media_files:
+        hashed_while_downloading = media_file['hash']
+        set_media_hash(media_file)
+        assert media_file['hash'] == hashed_while_downloading
+        assert media_file['hash'] == hashlib.sha256(contents[media_file['id']]).hexdigest()
+    # Only content over the threshold went to a file on disk
+    big = media_files[1]['content']
+    assert os.fstat(big.fileno()).st_size == len(contents['big'])
+    assert getattr(media_files[0]['content'], 'name', None) is None
+
+    monkeypatch.chdir(tmp_path)
+    save_to_local('drive', [], [], media_files, skip_media=False)
+    media_dir, = [p for p in os.listdir(tmp_path) if p.startswith('scrape_media')]
+    for media_file in media_files:
+        with open(os.path.join(media_dir, media_file['hash']), 'rb') as f:
+            assert f.read() == contents[media_file['id']]
+
+    close_contents(media_files)
+    assert big.closed and 'content' not in media_files[1]
+
+
+def test_media_cache(tmp_path):
+    contents = {'a': b'a' * 100, 'b': b'b' * 100, 'c': b'a' * 100}
+    fake_http = FakeDriveHttp(contents)
+    factory, _ = fake_drive_factory(fake_http)
+    media_files = [{'id': file_id, 'mimeType': 'jpg', 'md5Checksum': file_id}
+                   for file_id in contents]
+    cache_dir = str(tmp_path / 'cache')
+
+    media_cache = MediaCache(cache_dir, max_bytes=1000)
+    assert not any(media_cache.get(mf) for mf in media_files)
+    download_files(media_files, factory, workers=2)
+    for media_file in media_files:
+        media_cache.put(media_file)
+    media_cache.save()
+    # a and c have the same content so it is only stored once
+    assert len(os.listdir(os.path.join(cache_dir, 'objects'))) == 2
+
+    # a fresh run finds everything without touching the network
+    media_cache = MediaCache(cache_dir, max_bytes=150)
+    rerun = [{k: v for k, v in mf.items() if k != 'content'} for mf in media_files]
+    rerun[1]['md5Checksum'] = 'changed'
+    assert [media_cache.get(mf) for mf in rerun] == [True, False, True]
+    for media_file in (rerun[0], rerun[2]):
+        with open_content(media_file) as content:
+            assert content.read() == contents[media_file['id']]
+
+    # b is now the least recently used so it goes first
+    media_cache.save()
+    assert os.listdir(os.path.join(cache_dir, 'objects')) == [rerun[0]['hash']]
+    assert len(MediaCache(cache_dir).entries) == 2
+
+
+def test_checkpoint(tmp_path):
+    text_file = make_text_file(TEST_TEXT_CONTENT)
+    text_file.update({'id': 'file0', 'modifiedTime': '2020-07-28T20:00:00Z'})
+    msgs = merge_all_msgs(process_text_file(text_file, {}, 0, "g/drive/dir"))
+
+    checkpoint = Checkpoint('drive', checkpoint_dir=str(tmp_path))
+    assert not checkpoint.is_unchanged(text_file)
+    checkpoint.update([text_file], msgs[-3:])
+    checkpoint.save()
+
+    checkpoint = Checkpoint('drive', checkpoint_dir=str(tmp_path))
+    assert checkpoint.is_unchanged(text_file)
+    assert not checkpoint.is_unchanged(dict(text_file, modifiedTime='later'))
+    group_id = msgs[0].group_id
+    assert checkpoint.since(group_id) == datetime(2020, 7, 28, 19, 50)
+    assert checkpoint.groups[group_id]['last_msg']['content'] == 'OK'
+
+    # a changed export only parses from the tail onward
+    text_file_1 = make_text_file(TEST_TEXT_CONTENT + TEST_TEXT_CONTENT_2)
+    tail = process_text_file(text_file_1, {}, 0, "g/drive/dir",
+                             since=checkpoint.since(group_id))
+    assert [m.content for m in tail] == [
+        'Yea\nLet me write\nThree lines', 'Call me', 'OK',
+        'Where did you go?', 'Back']
+    assert [m.order for m in tail] == list(range(5))
+
+
+def test_checkpoint_mongo():
+    mongomock = pytest.importorskip('mongomock')
+    coll = mongomock.MongoClient().db.checkpoints
+    checkpoint = Checkpoint('drive', coll=coll)
+    checkpoint.files['file0'] = 'time0'
+    checkpoint.save()
+    checkpoint.save()
+    assert coll.count_documents({}) == 1
+    assert Checkpoint('drive', coll=coll).is_unchanged(
+        {'id': 'file0', 'modifiedTime': 'time0'})
+    assert Checkpoint('other', coll=coll).files == {}
+
+
+def run_incremental(tmp_path, monkeypatch, content, out_name, **kwargs):
+    """
+    main on a local export of one group with content, saving to out_name
+    """
+    export_dir = tmp_path / 'export'
+    export_dir.mkdir(exist_ok=True)
+    text_path = export_dir / 'WhatsApp Chat with a.txt'
+    text_path.write_text(content)
+    # A modifiedTime of its own, even within the clock's resolution
+    os.utime(text_path, (0, len(list(tmp_path.iterdir()))))
+    out_dir = tmp_path / out_name
+    out_dir.mkdir()
+    monkeypatch.chdir(out_dir)
+    main(None, str(export_dir), skip_media=True, salt_not_required=False,
+         **kwargs)
+    merged = []
+    for merged_path in out_dir.glob('merged_scrape_*_export.json'):
+        with open(merged_path) as f:
+            merged = json.load(f)
+    return merged
+
+
+def test_main_incremental(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr('whatsapp_scraper.CHECKPOINT_TAIL_MSGS', 3)
+    appended = TEST_TEXT_CONTENT + TEST_TEXT_CONTENT_2
+    edited = appended.replace('Back', MSG_DELETED) + \
+        "28/07/20, 9:31 pm - +91 12345 12345: Sorry\n"
+    full = run_incremental(tmp_path, monkeypatch, appended, 'full', local=True)
+    full_edited = run_incremental(tmp_path, monkeypatch, edited, 'full_edited',
+                                  local=True)
+
+    for pipeline in (False, True):
+        kwargs = dict(local=True, incremental=True, pipeline=pipeline,
+                      checkpoint_dir=str(tmp_path / ('checkpoints_%s' % pipeline)))
+        first = run_incremental(tmp_path, monkeypatch, TEST_TEXT_CONTENT,
+                                'first_%s' % pipeline, **kwargs)
+        assert first == full[:len(first)]
+
+        # Only the tail is parsed, and merged as it is in the full export
+        tail = run_incremental(tmp_path, monkeypatch, appended,
+                               'tail_%s' % pipeline, **kwargs)
+        assert len(tail) < len(full)
+        assert tail == full[-len(tail):]
+
+        # An export that no longer holds the last merged message is parsed
+        # in full
+        caplog.clear()
+        rerun = run_incremental(tmp_path, monkeypatch, edited,
+                                'edited_%s' % pipeline, **kwargs)
+        assert "doesn't continue the checkpoint" in caplog.text
+        assert rerun == full_edited
+
+
+def test_main_incremental_remote(tmp_path, monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    monkeypatch.setattr('whatsapp_scraper.CHECKPOINT_TAIL_MSGS', 3)
+    for name in REQ_WHATSAPP_ENV_VARS:
+        monkeypatch.setenv(name, name)
+    appended = TEST_TEXT_CONTENT + TEST_TEXT_CONTENT_2
+    full = run_incremental(tmp_path, monkeypatch, appended, 'full', local=True)
+
+    for pipeline in (False, True):
+        db = mongomock.MongoClient().db
+        monkeypatch.setattr('whatsapp_scraper.initialize_mongo',
+                            lambda: (db.files, db.msgs))
+        monkeypatch.setattr('whatsapp_scraper.initialize_s3',
+                            lambda: ('bucket', None))
+        kwargs = dict(local=False, incremental=True, pipeline=pipeline,
+                      checkpoint_dir=str(tmp_path / ('checkpoints_%s' % pipeline)))
+        run_incremental(tmp_path, monkeypatch, TEST_TEXT_CONTENT,
+                        'first_%s' % pipeline, **kwargs)
+        [first_file] = db.files.find()
+        run_incremental(tmp_path, monkeypatch, appended,
+                        'tail_%s' % pipeline, **kwargs)
+
+        # The tail isn't saved as if it were the whole export
+        assert list(db.files.find()) == [first_file]
+        stored = list(db.msgs.find({}, projection={'_id': False},
+                                   sort=[('order', 1)]))
+        assert stored == full
+
+
+def test_partition_media_files():
+    media_files = [{'name': 'IMG-W%d.jpg' % i} for i in range(4)]
+    media_msgs = [Msg(has_media=True, media_file=media_files[2]),
+                  Msg(has_media=True),
+                  Msg(has_media=True, media_file=media_files[0])]
+    referenced, unreferenced = partition_media_files(media_files, media_msgs)
+    assert referenced == [media_files[0], media_files[2]]
+    assert unreferenced == [media_files[1], media_files[3]]
+    assert filter_superfluous_media_files(media_files, media_msgs) == referenced
+
+
+def make_group(contents, start=0):
+    return [Msg(group_id='a', order=i, content=content,
+                sender_id='s%d' % ((start + i) % 3),
+                dt=TEST_DT + MINUTES * ((start + i) // 4))
+            for i, content in enumerate(contents)]
+
+
+def test_find_offset():
+    contents = ['msg %d' % i for i in range(60)]
+    msgs = make_group(contents)
+
+    # b starts partway through a
+    assert find_offset(msgs, make_group(contents[24:], 24)) == 24
+
+    # b starts with a message that was deleted in a
+    msgs_a = make_group(contents[:40])
+    msgs_a[24].content = MSG_DELETED
+    assert find_offset(msgs_a, make_group(contents[24:], 24)) == 24
+
+    # a short overlap is fine as long as it is half of the shorter list
+    assert find_offset(msgs, make_group(contents[56:], 56)) == 56
+
+    # b starts in the same minute but before a
+    assert find_offset(make_group(contents[2:], 2), msgs) == -2
+
+    with pytest.raises(AssertionError):
+        find_offset(msgs, make_group(['other %d' % i for i in range(24, 60)], 24))
+
+
+def test_merge_msgs_in_group_many_files():
+    contents = ['msg %d' % i for i in range(100)]
+    files = [(0, 40), (30, 70), (60, 100), (10, 35), (90, 100)]
+    msgs = []
+    for file_idx, (start, end) in enumerate(files):
+        file_msgs = make_group(contents[start:end], start)
+        for msg in file_msgs:
+            msg.file_idx = file_idx
+        msgs += file_msgs
+
+    merged = merge_msgs_in_group('a', msgs)
+    assert [m.content for m in merged] == contents
+    assert [m.order for m in merged] == list(range(100))
+
+
+def test_merge_msgs_in_group_one_msg_overlap():
+    # Only the last message of a is in b. That's too short an overlap for
+    # a list of 100, even though a is merged from a window of its tail
+    msgs_a = [Msg(group_id='a', order=i, content='a %d' % i, sender_id='s',
+                  dt=TEST_DT + MINUTES * i, file_idx=0) for i in range(100)]
+    msgs_b = [Msg(group_id='a', order=i, content='b %d' % i, sender_id='s',
+                  dt=TEST_DT + MINUTES * (99 + i), file_idx=1)
+              for i in range(10)]
+    msgs_b[0].content = msgs_a[-1].content
+    with pytest.raises(AssertionError, match="do not overlap"):
+        merge_two_msg_lists(copy.deepcopy(msgs_a), copy.deepcopy(msgs_b))
+    with pytest.raises(AssertionError, match="do not overlap"):
+        merge_msgs_in_group('a', msgs_a + msgs_b)
+
+
+def test_save_msgs_to_mongo():
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+    create_indexes(db.files, db.msgs)
+    assert 'msgs_hash_1' in db.files.index_information()
+    contents = ['msg %d' % i for i in range(70)]
+
+    inserted = save_msgs_to_mongo(db.msgs, make_group(contents[:50]))
+    assert len(inserted) == 50
+
+    # Only the tail that could overlap messages from 40 on comes back
+    window = find_overlap_window(db.msgs, 'a', make_group(contents[40:], 40)[0].dt)
+    assert [m['order'] for m in window] == list(range(31, 50))
+    assert '_id' not in window[0]
+
+    inserted = save_msgs_to_mongo(db.msgs, make_group(contents[40:], 40))
+    assert [m.content for m in inserted] == contents[50:]
+    stored = list(db.msgs.find({'group_id': 'a'}, sort=[('order', 1)]))
+    assert [m['content'] for m in stored] == contents
+    assert [m['order'] for m in stored] == list(range(70))
+
+
+def test_upload_media_to_s3():
+    moto = pytest.importorskip('moto')
+    boto3 = pytest.importorskip('boto3')
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='bucket')
+        s3.put_object(Bucket='bucket', Key='hash0', Body=b'already there')
+        media_files = [
+            {'hash': 'hash%d' % i, 'mimeType': 'image/jpeg',
+             'content': io.BytesIO(b'image %d' % i)} for i in range(4)]
+        media_files.append(dict(media_files[1], content=io.BytesIO(b'image 1')))
+
+        uploaded = upload_media_to_s3(s3, 'bucket', media_files, workers=2)
+        assert uploaded == media_files[1:4]
+        obj = s3.get_object(Bucket='bucket', Key='hash2')
+        assert obj['Body'].read() == b'image 2'
+        assert obj['ContentType'] == 'image/jpeg'
+        assert s3.get_object(Bucket='bucket', Key='hash0')['Body'].read() == \
+            b'already there'
+
+        assert upload_media_to_s3(s3, 'bucket', media_files) == []
+
+
+def make_drive_folder():
+    contents = {
+        't0': TEST_TEXT_CONTENT.encode(),
+        't1': TEST_TEXT_CONTENT_1.encode(),
+        't2': TEST_TEXT_CONTENT_2.encode(),
+        'm0': b'image 0',
+        'm1': b'image 1',
+        'm9': b'never referenced',
+    }
+    text_files = [{'id': file_id, 'name': 'WhatsApp Chat with ' + group,
+                   'mimeType': 'text/plain'}
+                  for file_id, group in (('t0', 'a'), ('t1', 'a'), ('t2', 'b'))]
+    media_files = [{'id': 'm%d' % i, 'name': 'IMG-W%d.jpg' % i,
+                    'mimeType': 'image/jpeg'} for i in (0, 1, 9)]
+    return contents, text_files, media_files
+
+
+def test_pipeline():
+    anonymizer = Anonymizer()
+
+    # The steps of main, one after the other
+    contents, text_files, media_files = make_drive_folder()
+    factory, _ = fake_drive_factory(FakeDriveHttp(contents))
+    download_files(text_files, factory)
+    msgs = []
+    for file_idx, text_file in enumerate(text_files):
+        msgs += process_text_file(text_file, {mf['name']: mf for mf in media_files},
+                                  file_idx, 'drive', anonymizer)
+    media_msgs = [m for m in msgs if m.has_media]
+    media_files, unreferenced = partition_media_files(media_files, media_msgs)
+    download_files(media_files, factory)
+    for media_msg in media_msgs:
+        media_msg.process_media_msg()
+    msgs_to_insert = merge_all_msgs(msgs)
+
+    # The same overlapped. A queue of one still gets through every file
+    contents, p_text_files, p_media_files = make_drive_folder()
+    fake_http = FakeDriveHttp(contents)
+    factory, _ = fake_drive_factory(fake_http)
+    pipeline = Pipeline('drive', factory, {mf['name']: mf for mf in p_media_files},
+                        anonymizer, download_workers=2, queue_size=1)
+    p_msgs, p_msgs_to_insert, p_media_files, p_unreferenced = \
+        pipeline.run(p_text_files, p_media_files)
+
+    assert [m.as_dict() for m in p_msgs] == [m.as_dict() for m in msgs]
+    assert [m.as_dict() for m in p_msgs_to_insert] == \
+        [m.as_dict() for m in msgs_to_insert]
+    assert [mf['hash'] for mf in p_media_files] == \
+        [mf['hash'] for mf in media_files]
+    assert [mf['id'] for mf in p_unreferenced] == \
+        [mf['id'] for mf in unreferenced] == ['m9']
+    assert 'm9' not in fake_http.requested
+
+    contents, p_text_files, p_media_files = make_drive_folder()
+    factory, _ = fake_drive_factory(FakeDriveHttp(contents))
+    pipeline = Pipeline('drive', factory, {mf['name']: mf for mf in p_media_files},
+                        anonymizer, merge_workers=2)
+    _, p_msgs_to_insert, _, _ = pipeline.run(p_text_files, p_media_files)
+    assert [m.as_dict() for m in p_msgs_to_insert] == \
+        [m.as_dict() for m in msgs_to_insert]
+
+
+def test_pipeline_remote():
+    mongomock = pytest.importorskip('mongomock')
+    moto = pytest.importorskip('moto')
+    boto3 = pytest.importorskip('boto3')
+    db = mongomock.MongoClient().db
+    contents, text_files, media_files = make_drive_folder()
+    factory, _ = fake_drive_factory(FakeDriveHttp(contents))
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='bucket')
+        pipeline = Pipeline('drive', factory, {mf['name']: mf for mf in media_files},
+                            Anonymizer(), all_files_coll=db.files,
+                            merged_msgs_coll=db.msgs, s3=s3, bucket='bucket')
+        _, msgs_to_insert, media_files, _ = pipeline.run(text_files, media_files)
+        keys = [obj['Key'] for obj in s3.list_objects(Bucket='bucket')['Contents']]
+
+    assert sorted(keys) == sorted(mf['hash'] for mf in media_files)
+    assert db.msgs.count_documents({}) == len(msgs_to_insert) > 0
+    assert db.files.count_documents({}) == 3
+
+
+def test_msg_batch():
+    contents = ['msg %d' % i for i in range(100)]
+    msgs = []
+    for file_idx, (start, end) in enumerate(((0, 40), (30, 70), (60, 100))):
+        file_msgs = make_group(contents[start:end], start)
+        for msg in file_msgs:
+            msg.file_idx = file_idx
+        msgs += file_msgs
+    msgs[35].content = MSG_DELETED
+    msgs[45].make_media_msg({'name': 'IMG-W0.jpg'})
+    batch = MsgBatch.from_msgs(('GOOGLE_DRIVE', '', 'a'), msgs)
+    assert len(batch.sender_ids) == 3
+    assert [m.as_dict() for m in batch.to_msgs()] == [m.as_dict() for m in msgs]
+    assert batch.msg(45).media_file == {'placeholder': True}
+    assert [id(msgs[pos]) for pos in batch.sorted_positions()] == \
+        [id(m) for m in sorted(msgs, key=msg_sort)]
+
+    # A batch merged where it's built isn't packed, and merges the same
+    unpacked = MsgBatch.from_msgs(('GOOGLE_DRIVE', '', 'a'), msgs, packed=False)
+    assert not unpacked.sender_ids
+    assert [m.as_dict() for m in unpacked.to_msgs()] == [m.as_dict() for m in msgs]
+    assert unpacked.merge() == batch.merge()
+
+    # msg 35 was deleted in the first file and has media in the second
+    merged = msgs_from_merged_batch(msgs, *batch.merge())
+    assert [m.content for m in merged] == ['msg %d' % i for i in range(100)]
+    assert [m.order for m in merged] == list(range(100))
+    assert [i for i, m in enumerate(merged) if m.media_file] == [35]
+    assert merged[35].media_file == {'name': 'IMG-W0.jpg'}
+
+
+def test_merge_all_msgs_in_pool():
+    def make_msgs():
+        msgs = []
+        for group in range(4):
+            for file_idx, content in enumerate((TEST_TEXT_CONTENT,
+                                                TEST_TEXT_CONTENT_1)):
+                text_file = make_text_file(content, "group %d" % group)
+                msgs += process_text_file(text_file, {}, file_idx, "g/drive/dir")
+        msgs[1].make_media_msg({'name': 'IMG-W0.jpg'})
+        return msgs
+
+    serial = merge_all_msgs(make_msgs())
+    in_pool = merge_all_msgs(make_msgs(), workers=2)
+    assert [m.as_dict() for m in in_pool] == [m.as_dict() for m in serial]
+    assert [m.file_idx for m in in_pool] == [m.file_idx for m in serial]
+    assert in_pool[1].media_file == {'name': 'IMG-W0.jpg'}
+
+
+def test_main_batch(tmp_path, monkeypatch):
+    contents, text_files, media_files = make_drive_folder()
+    folders = {'f0': text_files[:2] + media_files[:2],
+               'f1': text_files[2:] + media_files[2:]}
+    fake_http = FakeDriveHttp(contents, folders=folders)
+    factory, services = fake_drive_factory(fake_http)
+    monkeypatch.setattr('whatsapp_scraper.build_gdrive_service',
+                        lambda creds: factory())
+    monkeypatch.chdir(tmp_path)
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text("# folders to scrape\n"
+                        "drive.google.com/drive/folders/f0\n\n"
+                        "drive.google.com/drive/folders/f1\n"
+                        "drive.google.com/not_a_folder\n")
+
+    with SharedResources(None, download_workers=2) as shared:
+        failed = main_batch(shared, read_manifest(str(manifest)),
+                            folder_workers=2, local=True, skip_media=False,
+                            salt_not_required=False)
+
+    assert failed == ['drive.google.com/not_a_folder']
+    for drive_id in folders:
+        assert len(list(tmp_path.glob('merged_scrape_*_%s.json' % drive_id))) == 1
+    assert len(list(tmp_path.glob('scrape_media_*_f0/*'))) == 2
+    # Folders share the download threads and their Drive services
+    assert len(services) == len(set(services)) <= 2 + 2
+
+
+def test_main_batch_shares_merge_processes(tmp_path, monkeypatch):
+    contents, text_files, media_files = make_drive_folder()
+    folders = {'f0': text_files[:2] + media_files[:2],
+               'f1': text_files[2:] + media_files[2:]}
+    factory, _ = fake_drive_factory(FakeDriveHttp(contents, folders=folders))
+    monkeypatch.setattr('whatsapp_scraper.build_gdrive_service',
+                        lambda creds: factory())
+    pools = []
+    monkeypatch.setattr('whatsapp_scraper.merge_process_pool',
+                        lambda workers, pool=merge_process_pool:
+                        pools.append(workers) or pool(workers))
+    monkeypatch.chdir(tmp_path)
+    locations = ['drive.google.com/drive/folders/%s' % f for f in folders]
+
+    for pipeline in (False, True):
+        with SharedResources(None, merge_workers=2) as shared:
+            assert main_batch(shared, locations, folder_workers=2, local=True,
+                              skip_media=True, salt_not_required=False,
+                              merge_workers=2, pipeline=pipeline) == []
+    # One pool per batch, not one per folder
+    assert pools == [2, 2]
+
+
+def test_media_cache_smaller_than_a_run(tmp_path, monkeypatch):
+    # Eviction mustn't delete cached media before the run has saved it.
+    # The cache holds one image, so every run hits one and evicts it
+    contents, text_files, media_files = make_drive_folder()
+    for media_file in media_files:
+        media_file['md5Checksum'] = media_file['id']
+    fake_http = FakeDriveHttp(contents, folders={'f0': text_files + media_files})
+    factory, _ = fake_drive_factory(fake_http)
+    monkeypatch.setattr('whatsapp_scraper.build_gdrive_service',
+                        lambda creds: factory())
+    monkeypatch.chdir(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+
+    for pipeline in (False, True, False):
+        for media_dir in tmp_path.glob('scrape_media_*'):
+            shutil.rmtree(media_dir)
+        with SharedResources(None, media_cache_dir=cache_dir,
+                             media_cache_max_bytes=len(b'image 0')) as shared:
+            main(None, 'drive.google.com/drive/folders/f0', local=True,
+                 skip_media=False, salt_not_required=False, pipeline=pipeline,
+                 shared=shared)
+        saved = sorted(p.read_bytes() for p in tmp_path.glob('scrape_media_*/*'))
+        assert saved == [b'image 0', b'image 1']
+        assert len(os.listdir(os.path.join(cache_dir, 'objects'))) == 1
+
+
+def test_media_cache_shared_by_folders(tmp_path, monkeypatch):
+    # Two folders with the same exports but different media, scraped at the
+    # same time into one cache
+    contents, text_files, media_files = make_drive_folder()
+    folders = {'f0': text_files[:2] + media_files[:2], 'f1': []}
+    for file_dict in folders['f0']:
+        other = dict(file_dict, id=file_dict['id'] + 'b')
+        contents[other['id']] = contents[file_dict['id']].replace(
+            b'image', b'other image')
+        folders['f1'].append(other)
+    for media_file in folders['f0'][2:] + folders['f1'][2:]:
+        media_file['md5Checksum'] = media_file['id']
+    fake_http = FakeDriveHttp(contents, folders=folders)
+    factory, _ = fake_drive_factory(fake_http)
+    monkeypatch.setattr('whatsapp_scraper.build_gdrive_service',
+                        lambda creds: factory())
+    monkeypatch.chdir(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    locations = ['drive.google.com/drive/folders/%s' % f for f in folders]
+
+    for pipeline in (False, True):
+        fake_http.requested.clear()
+        for media_dir in tmp_path.glob('scrape_media_*'):
+            shutil.rmtree(media_dir)
+        with SharedResources(None, media_cache_dir=cache_dir) as shared:
+            assert main_batch(shared, locations, folder_workers=2, local=True,
+                              skip_media=False, salt_not_required=False,
+                              pipeline=pipeline) == []
+        # Neither folder's save dropped the other's media
+        with open(os.path.join(cache_dir, 'index.json')) as f:
+            assert len(json.load(f)) == 4
+        assert len(os.listdir(os.path.join(cache_dir, 'objects'))) == 4
+    # The second batch found all the media in the cache
+    assert not [file_id for file_id in fake_http.requested
+                if file_id.startswith('m')]
+
+
+def test_heavy_imports_are_lazy():
+    heavy = ('boto3', 'botocore', 'pymongo', 'dateutil', 'googleapiclient',
+             'google_auth_oauthlib', 'google.oauth2')
+    loaded = subprocess.run(
+        [sys.executable, '-c',
+         'import sys, whatsapp_scraper; print(" ".join(sys.modules))'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+        capture_output=True, text=True).stdout.split()
+    assert not [m for m in heavy if m in loaded]
+
+
+def make_export_dir(export_dir):
+    """
+    make_drive_folder written to disk, with each export of group a in its
+    own directory
+    """
+    contents, text_files, media_files = make_drive_folder()
+    for sub_dir, text_file in zip(('week1', 'week2', ''), text_files):
+        (export_dir / sub_dir).mkdir(parents=True, exist_ok=True)
+        (export_dir / sub_dir / (text_file['name'] + '.txt')).write_bytes(
+            contents[text_file['id']])
+    for media_file in media_files:
+        (export_dir / media_file['name']).write_bytes(contents[media_file['id']])
+    return contents, text_files, media_files
+
+
+def test_main_closes_resources_on_failure(tmp_path, monkeypatch):
+    make_export_dir(tmp_path / 'export')
+    monkeypatch.chdir(tmp_path)
+    closed = []
+    monkeypatch.setattr(SharedResources, 'close',
+                        lambda self: closed.append(self))
+
+    def fail(*args):
+        raise RuntimeError("merge failed")
+    monkeypatch.setattr('whatsapp_scraper.merge_all_msgs', fail)
+    with pytest.raises(RuntimeError):
+        main(None, str(tmp_path / 'export'), local=True, skip_media=True,
+             salt_not_required=False)
+    assert len(closed) == 1
+
+
+def test_local_sources(tmp_path, monkeypatch):
+    export_dir = tmp_path / 'export'
+    contents, text_files, media_files = make_export_dir(export_dir)
+    archive = tmp_path / 'export.zip'
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for path in export_dir.rglob('*'):
+            zf.write(path, path.relative_to(export_dir))
+
+    results = {}
+    for location, pipeline in ((export_dir, False), (archive, False),
+                               (archive, True)):
+        out_dir = tmp_path / ('out_%s_%s' % (location.name, pipeline))
+        out_dir.mkdir()
+        monkeypatch.chdir(out_dir)
+        main(None, str(location), local=True, skip_media=False,
+             salt_not_required=False, pipeline=pipeline)
+        [merged_path] = out_dir.glob('merged_scrape_*_%s.json' % location.name)
+        with open(merged_path) as f:
+            results[location.name, pipeline] = json.load(f)
+        # Only referenced media is saved, straight out of the dir or archive
+        assert sorted(p.read_bytes() for p in out_dir.glob('scrape_media_*/*')) \
+            == [b'image 0', b'image 1']
+
+    from_dir = results['export', False]
+    assert {m['source_type'] for m in from_dir} == {LOCAL_DIR}
+    for key in (('export.zip', False), ('export.zip', True)):
+        assert {m['source_type'] for m in results[key]} == {ZIP_ARCHIVE}
+        assert [(m['content'], m['media_upload_loc']) for m in results[key]] \
+            == [(m['content'], m['media_upload_loc']) for m in from_dir]
+    # and are the messages the same exports give from Drive
+    msgs = []
+    for file_idx, text_file in enumerate(text_files):
+        text_file['content'] = io.BytesIO(contents[text_file['id']])
+        msgs += process_text_file(text_file, {}, file_idx, 'drive')
+    assert sorted(m['content'] for m in from_dir) == \
+        sorted(m.content for m in merge_all_msgs(msgs))
+
+
+def test_manifest_of_local_exports(tmp_path):
+    # No Drive credentials are needed when nothing is on Drive
+    make_export_dir(tmp_path / 'export0')
+    make_export_dir(tmp_path / 'export1')
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text("export0\nexport1\n")
+    assert not needs_gdrive_credentials(read_manifest(str(manifest)))
+    assert needs_gdrive_credentials(['export0', 'drive.google.com/drive/folders/f0'])
+
+    subprocess.run([sys.executable,
+                    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'whatsapp_scraper.py'),
+                    'missing_creds.json', '--manifest', str(manifest),
+                    '--local', '--skip-media'],
+                   cwd=tmp_path, check=True, capture_output=True,
+                   env=dict(os.environ, SCRAPER_SALT='x'))
+    for name in ('export0', 'export1'):
+        assert len(list(tmp_path.glob('merged_scrape_*_%s.json' % name))) == 1
+
+
+def test_generate_exports(tmp_path):
+    from bench_scraper import generate_exports
+
+    counts = generate_exports(str(tmp_path / 'a'), 2000, num_groups=2,
+                              num_exports=3, seed=1)
+    generate_exports(str(tmp_path / 'b'), 2000, num_groups=2,
+                     num_exports=3, seed=1)
+    assert counts['text_files'] == 6
+    for path in (tmp_path / 'a').rglob('*.*'):
+        assert path.read_bytes() == \
+            (tmp_path / 'b' / path.relative_to(tmp_path / 'a')).read_bytes()
+
+    text_files, media_files = separate_text_and_media_files(
+        get_files_from_local_dir(str(tmp_path / 'a')))
+    assert len(media_files) == counts['media_files']
+    media_files_by_name = {mf['name']: mf for mf in media_files}
+    msgs = []
+    for file_idx, text_file in enumerate(text_files):
+        msgs += process_text_file(text_file, media_files_by_name, file_idx, 'a')
+    media_msgs = [m for m in msgs if m.has_media]
+    assert all(m.media_file for m in media_msgs)
+    referenced, unreferenced = partition_media_files(media_files, media_msgs)
+    assert len(referenced) == len(unreferenced)
+
+    # The overlap between exports merges away. Only actions aren't messages
+    merged = merge_all_msgs(msgs)
+    assert len(merged) < counts['msgs'] < len(msgs)
+    assert len(merged) > counts['msgs'] * 0.95
+
+
+def test_run_report(tmp_path, monkeypatch, capsys):
+    make_export_dir(tmp_path / 'export')
+    monkeypatch.chdir(tmp_path)
+    # Without a report path the report goes to stderr
+    main(None, str(tmp_path / 'export'), local=True, skip_media=True,
+         salt_not_required=False)
+    assert not list(tmp_path.glob('run_report_*'))
+    report = json.loads(capsys.readouterr().err.splitlines()[-1])
+    assert report['labels']['source_loc'] == 'export'
+
+    for pipeline in (False, True):
+        report_path = tmp_path / ('report_{source_loc}_%s.json' % pipeline)
+        prom_path = tmp_path / ('{source_loc}_%s.prom' % pipeline)
+        main(None, str(tmp_path / 'export'), local=True, skip_media=True,
+             salt_not_required=False, pipeline=pipeline,
+             report_path=str(report_path), prometheus_path=str(prom_path))
+
+        with open(str(report_path).replace('{source_loc}', 'export')) as f:
+            report = json.load(f)
+        assert report['labels'] == {'source_type': LOCAL_DIR,
+                                    'source_loc': 'export'}
+        assert {'list', 'parse', 'merge'} <= set(report['stages'])
+        assert report['counters']['text_files'] == 3
+        assert report['counters']['msgs'] == sum(
+            m['msgs'] for m in report['merges'].values())
+        assert report['counters']['merged_msgs'] < report['counters']['msgs']
+        assert len(report['merges']) == 2
+        assert report['peak_rss_bytes'] > 1e6
+
+        with open(str(prom_path).replace('{source_loc}', 'export')) as f:
+            lines = f.read().splitlines()
+        assert ('whatsapp_scraper_count{name="text_files",source_loc="export",'
+                'source_type="LOCAL_DIR"} 3.0') in lines
+        for line in lines:
+            assert re.match(r'# (HELP|TYPE) whatsapp_scraper_\w+ .+$', line) or \
+                re.match(r'whatsapp_scraper_\w+\{[^}]*\} [0-9.e+-]+$', line)
+
+
+def test_profile(tmp_path, monkeypatch, capsys):
+    make_export_dir(tmp_path / 'export')
+    monkeypatch.chdir(tmp_path)
+    main(None, str(tmp_path / 'export'), local=True, skip_media=True,
+         salt_not_required=False, pipeline=False, profile=('cpu', 'memory'),
+         profile_dir=str(tmp_path / 'profile_{source_loc}'))
+
+    profile_dir = tmp_path / 'profile_export'
+    for stage in ('list', 'parse', 'merge', 'save_local'):
+        stats = pstats.Stats(str(profile_dir / f'profile_{stage}.pstats'))
+        if stage == 'parse':
+            assert 'iter_text_file_msgs' in {
+                func for _, _, func in stats.stats}
+        tracemalloc.Snapshot.load(str(profile_dir / f'profile_{stage}.tracemalloc'))
+        assert (profile_dir / f'profile_{stage}.txt').read_text()
+    assert not tracemalloc.is_tracing()
+    out = capsys.readouterr().out
+    assert 'Hottest functions in list, parse, merge, save_local' in out
+    assert 'Biggest allocations in parse' in out
+
+
+def test_profilers_share_tracemalloc(tmp_path):
+    # Folders of a manifest run are profiled at the same time. The first one
+    # to finish mustn't stop tracing under the others
+    first = StageProfiler(('memory',), str(tmp_path / 'a'))
+    second = StageProfiler(('memory',), str(tmp_path / 'b'))
+    with first.profile('parse'):
+        pass
+    first.save()
+    assert tracemalloc.is_tracing()
+    with second.profile('parse'):
+        pass
+    second.save()
+    assert not tracemalloc.is_tracing()
+    assert (tmp_path / 'b' / 'profile_parse.tracemalloc').exists()
+
+    # Nor stop tracing someone else started
+    tracemalloc.start()
+    try:
+        StageProfiler(('memory',), str(tmp_path / 'c')).save()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_write_records(tmp_path):
+    records = [{'i': i, 'text': 'line %d, with [brackets] and \u00fcnicode\n' % i * (i % 7)}
+               for i in range(500)]
+    compressions = [None, 'gzip']
+    try:
+        import zstandard  # noqa: F401
+        compressions.append('zstd')
+    except ImportError:
+        pass
+    for output_format in OUTPUT_FORMATS:
+        for compression in compressions:
+            path = str(tmp_path / ('records.' + output_format
+                                   + COMPRESSIONS.get(compression, '')))
+            assert write_records(path, iter(records), output_format,
+                                 compression) == len(records)
+            # Small chunks cut records in two
+            assert list(iter_records(path, chunk_size=50)) == records
+
+    # Same as the json the scraper wrote before
+    assert (tmp_path / 'records.json').read_text() == json.dumps(records)
+    with open(tmp_path / 'records.ndjson') as f:
+        assert [json.loads(line) for line in f] == records
+
+    write_records(str(tmp_path / 'empty.json'), [])
+    assert list(iter_records(str(tmp_path / 'empty.json'))) == []
+    (tmp_path / 'truncated.json').write_text('[{"a": 1}, {"b": ')
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_records(str(tmp_path / 'truncated.json'), chunk_size=4))
+
+
+def test_save_to_local_formats(tmp_path, monkeypatch):
+    make_export_dir(tmp_path / 'export')
+    monkeypatch.chdir(tmp_path)
+    for output_format, compression in (('json', None), ('ndjson', 'gzip')):
+        main(None, str(tmp_path / 'export'), local=True, skip_media=True,
+             salt_not_required=False, pipeline=False,
+             output_format=output_format, compression=compression)
+
+    for prefix in ('all_scrape', 'merged_scrape'):
+        [json_path] = tmp_path.glob(prefix + '_*_export.json')
+        [ndjson_path] = tmp_path.glob(prefix + '_*_export.ndjson.gz')
+        with open(json_path) as f:
+            msgs = json.load(f)
+        assert msgs and list(iter_records(str(ndjson_path))) == msgs